@@ -22,40 +22,125 @@ ALIASES = {
 }
 
 
+def compile_template(template):
+    """Parses a template into a list of pieces, each of which is one of:
+
+    * a string, which is copied as-is;
+    * a tuple of attribute names, the (alias-resolved) path in a reference
+      like `{subj.location.light}`;
+    * a list of the alternatives in a choice like `<gleam|glow|shine>`,
+      each of which is itself a list of strings and tuples.
+    """
+    def compile_text(text):
+        parts = []
+        for n, part in enumerate(re.split(r'\{([a-zA-Z0-9_.]+)\}', text)):
+            if n % 2 == 1:
+                parts.append(tuple([ALIASES.get(name, name) for name in part.split('.') if name]))
+            elif part:
+                parts.append(part)
+        return parts
+
+    pieces = []
+    for n, part in enumerate(re.split(r'\<(.*?)\>', template)):
+        if n % 2 == 1:
+            pieces.append([compile_text(option) for option in part.split('|')])
+        else:
+            pieces.extend(compile_text(part))
+    return pieces
+
+
+compiled_templates = {}
+
+
+class Registered(type):
+    """Metaclass which enters each class, when it is created, into the
+    `registry` of its hierarchy (if the hierarchy has one), a dict mapping
+    class names to classes, so that classes can be looked up by name
+    without scanning the globals of the modules that define them."""
+
+    def __init__(cls, name, bases, dict_):
+        super(Registered, cls).__init__(name, bases, dict_)
+        registry = getattr(cls, 'registry', None)
+        if registry is not None:
+            registry[name] = cls
+
+
+class Slotted(Registered):
+    """Metaclass which gives each class that has a `slots` tuple a real
+    `__slots__` layout generated from it, so that the fields are stored
+    directly on the instance, with no dict and no `__getattr__` involved.
+    (Any `__slots__` the class itself gives are kept, too.)
+
+    Classes whose `slots` is None keep their fields in a dict, `_attrs`.
+    """
+
+    def __new__(mcs, name, bases, dict_):
+        slots = dict_.get('slots', getattr(bases[0], 'slots', None))
+        if slots is None:
+            dict_['_fields'] = None
+        else:
+            inherited = set()
+            for base in bases:
+                for cls in base.__mro__:
+                    inherited.update(cls.__dict__.get('__slots__', ()))
+            dict_['__slots__'] = tuple(dict_.get('__slots__', ())) + tuple(
+                [key for key in slots if key not in inherited]
+            )
+            # Fields are listed in the order a dict of them iterates in,
+            # because that's what they used to be kept in, and some passes
+            # (e.g. assign_referents) depend on that order.
+            dict_['_fields'] = tuple(dict.fromkeys(slots))
+        return type.__new__(mcs, name, bases, dict_)
+
+
+def construct(cls, args, kwargs):
+    """Used to unpickle AST and Properties nodes."""
+    return cls(*args, **kwargs)
+
+
+def check_fields(obj, kwargs):
+    for key in kwargs:
+        if key not in obj.slots:
+            raise AttributeError(
+                "{0} has no attribute '{1}'".format(
+                    obj.__class__.__name__, key
+                )
+            )
+
+
 class AST(object):
+    __metaclass__ = Slotted
+    __slots__ = ('_children',)
     slots = None
     templates = None
 
     def __init__(self, *args, **kwargs):
         self._children = args
-        if self.slots is not None:
-            for key, value in kwargs.iteritems():
-                if key not in self.slots:
-                    raise AttributeError(
-                        "{0} has no attribute '{1}'".format(
-                            self.__class__.__name__, key
-                        )
-                    )
-            for key in self.slots:
-                kwargs.setdefault(key, None)
-        self._attrs = kwargs
+        if self._fields is None:
+            self._attrs = kwargs
+            return
+        check_fields(self, kwargs)
+        for key in self._fields:
+            setattr(self, key, kwargs.get(key))
 
     def __repr__(self):
         children = ', '.join([repr(c) for c in self._children])
-        attrs = ', '.join(['%s=%r' % (key, value) for key, value in self._attrs.iteritems() if value is not None])
+        attrs = ', '.join(['%s=%r' % (key, value) for key, value in self.iteritems() if value is not None])
         j = ', ' if children and attrs else ''
         return "%s(%s%s%s)" % (self.__class__.__name__, children, j, attrs)
 
     def repr_abbrev(self):
-        attrs = ', '.join(['%s=%r' % (key, value) for key, value in self._attrs.iteritems() if value is not None])
+        attrs = ', '.join(['%s=%r' % (key, value) for key, value in self.iteritems() if value is not None])
         return "%s(%s)" % (self.__class__.__name__, attrs)
 
     def dump(self, f, indent=0):
-        f.write(' ' * indent)
-        f.write(self.repr_abbrev())
-        f.write('\n')
-        for child in self:
-            child.dump(f, indent + 2)
+        stack = [(self, indent)]
+        while stack:
+            (ast, indent) = stack.pop()
+            f.write(' ' * indent)
+            f.write(ast.repr_abbrev())
+            f.write('\n')
+            stack.extend([(child, indent + 2) for child in reversed(ast._children)])
 
     def __getitem__(self, index):
         return self._children[index]
@@ -64,16 +149,36 @@ class AST(object):
         return self._children.__iter__()
 
     def __getattr__(self, name):
-        if name in self._attrs:
+        # only reached for fields of nodes which have no `slots`
+        if name != '_attrs' and self._fields is None and name in self._attrs:
             return self._attrs[name]
         raise AttributeError(name)
 
     def iteritems(self):
-        return self._attrs.iteritems()
+        if self._fields is None:
+            return self._attrs.iteritems()
+        return ((key, getattr(self, key)) for key in self._fields)
+
+    def __reduce__(self):
+        return (construct, (self.__class__, self._children, dict(self.iteritems())))
+
+    def rebuild(self, children, attrs):
+        """Returns a node of the same class with the given children and
+        attributes -- which is this very node, if they are all identical
+        to this node's, so that a rewrite which leaves a subtree alone
+        shares it instead of copying it."""
+        if (len(children) == len(self._children) and
+            all(a is b for (a, b) in zip(children, self._children))):
+            mine = list(self.iteritems())
+            if len(attrs) == len(mine) and all(
+                key in attrs and attrs[key] is value for (key, value) in mine
+            ):
+                return self
+        return self.__class__(*children, **attrs)
 
     def flatten(self):
         """Individual nodes which you want to flatten must define how they are to be flattened"""
-        return self.__class__(*[c.flatten() for c in self], **dict(self.iteritems()))
+        return self.rebuild([c.flatten() for c in self], dict(self.iteritems()))
 
     def insert(self, position, *args, **kwargs):
         """Returns a new AST node"""
@@ -86,22 +191,32 @@ class AST(object):
         return self.__class__(*children, **attrs)
 
     def render_t_impl(self, template):
-
-        def pick_one(match):
-            return random.choice(tuple(match.group(1).split('|')))
-        template = re.sub(r'\<(.*?)\>', pick_one, template)
-
-        def repl(match):
-            parts = [ALIASES.get(part, part) for part in match.group(1).split('.') if part]
-            try:
-                obj = self._attrs[parts.pop(0)]
-            except KeyError:
-                print self
-                raise
-            while parts:
-                obj = getattr(obj, parts.pop(0))
-            return obj
-        return re.sub(r'\{([a-zA-Z0-9_.]+)\}', repl, template)
+        pieces = compiled_templates.get(template)
+        if pieces is None:
+            pieces = compiled_templates[template] = compile_template(template)
+
+        # make all the choices first, then resolve the references
+        parts = []
+        for piece in pieces:
+            if isinstance(piece, list):
+                parts.extend(random.choice(piece))
+            else:
+                parts.append(piece)
+
+        text = []
+        for part in parts:
+            if isinstance(part, tuple):
+                try:
+                    obj = getattr(self, part[0])
+                except AttributeError:
+                    print self
+                    raise
+                for name in part[1:]:
+                    obj = getattr(obj, name)
+                text.append(obj)
+            else:
+                text.append(part)
+        return ''.join(text)
 
     def render_t(self, template):
         try:
@@ -115,52 +230,126 @@ class AST(object):
     def render(self):
         if self.templates:
             # TODO why is random.choice() not sufficient here?
-            template = random.shuffle_demon.choice(self.templates)
+            template = random.current().shuffle_demon.choice(self.templates)
             return self.render_t(template)
         raise NotImplementedError(repr(self))
 
+    def render_into(self, out):
+        """Appends the text of this node to `out`, a list of fragments of
+        text which will all be joined together once rendering is done."""
+        out.append(self.render())
+
     def __unicode__(self):
         return self.render()
 
 
+# - - - - traversal - - - -
+# These use an explicit stack instead of recursion, so that they work on
+# trees of any depth without running into Python's recursion limit.
+
+
+def walk(ast):
+    """Yields every node of the tree, in pre-order (which is story order.)"""
+    stack = [ast]
+    while stack:
+        ast = stack.pop()
+        yield ast
+        stack.extend(reversed(ast._children))
+
+
+def flattened_children(ast, cls):
+    """Yields the children of the given node, except that each child which
+    is an instance of `cls` is replaced by its own flattened children."""
+    stack = [iter(ast)]
+    while stack:
+        for child in stack[-1]:
+            if isinstance(child, cls):
+                stack.append(iter(child))
+                break
+            yield child
+        else:
+            stack.pop()
+
+
+def transform(ast, enter, leave=None):
+    """Returns a rewritten version of the tree.
+
+    `enter` is called on each node, in pre-order (which is story order),
+    and should return one of:
+
+    * a pair `(children, attrs)`: each of `children` is rewritten in turn,
+      then a node of the same class is built from them and `attrs`;
+    * an AST, which is used, as-is, in place of the node;
+    * None, which drops the node from its parent.
+
+    `leave`, if given, is called on each node whose children were rewritten,
+    once they all have been.
+
+    A node whose children and attributes all come out unchanged is not
+    copied; see AST.rebuild.
+    """
+    results = []
+    stack = [(None, None, iter((ast,)), results)]
+    while stack:
+        (node, attrs, children, done) = stack[-1]
+        for child in children:
+            entered = enter(child)
+            if entered is None:
+                continue
+            if isinstance(entered, AST):
+                done.append(entered)
+                continue
+            (grandchildren, child_attrs) = entered
+            stack.append((child, child_attrs, iter(grandchildren), []))
+            break
+        else:
+            stack.pop()
+            if node is not None:
+                if leave is not None:
+                    leave(node)
+                stack[-1][3].append(node.rebuild(done, attrs))
+    return results[0] if results else None
+
+
 # TODO AST should inherit from this
 
 class Properties(object):
     """Please treat as immutable"""
 
+    __metaclass__ = Slotted
+    __slots__ = ()
     slots = None
 
     def __init__(self, **kwargs):
-        if self.slots is not None:
-            for key, value in kwargs.iteritems():
-                if key not in self.slots:
-                    raise AttributeError(
-                        "{0} has no attribute '{1}'".format(
-                            self.__class__.__name__, key
-                        )
-                    )
-            for key in self.slots:
-                kwargs.setdefault(key, None)
-        self._attrs = kwargs
+        if self._fields is None:
+            object.__setattr__(self, '_attrs', kwargs)
+            return
+        check_fields(self, kwargs)
+        for key in self._fields:
+            object.__setattr__(self, key, kwargs.get(key))
 
     def __repr__(self):
-        attrs = ', '.join(['%s=%r' % (key, value) for key, value in self._attrs.iteritems() if value is not None])
+        attrs = ', '.join(['%s=%r' % (key, value) for key, value in self.iteritems() if value is not None])
         return "%s(%s)" % (self.__class__.__name__, attrs)
 
     def __getattr__(self, name):
-        if name in self._attrs:
+        # only reached for fields of objects which have no `slots`
+        if name != '_attrs' and self._fields is None and name in self._attrs:
             return self._attrs[name]
         raise AttributeError(name)
 
     def __setattr__(self, name, value):
-        if name not in ('_attrs',):
-            raise AttributeError(name)
-        return super(Properties, self).__setattr__(name, value)
+        raise AttributeError(name)
 
     def iteritems(self):
-        return self._attrs.iteritems()
+        if self._fields is None:
+            return self._attrs.iteritems()
+        return ((key, getattr(self, key)) for key in self._fields)
+
+    def __reduce__(self):
+        return (construct, (self.__class__, (), dict(self.iteritems())))
 
     def clone(self, **kwargs):
-        attrs = self._attrs.copy()
+        attrs = dict(self.iteritems())
         attrs.update(kwargs)
         return self.__class__(**attrs)
@@ -1,6 +1,8 @@
 import sys
 
 import marysue.util as random
+import marysue.instrument as instrument
+from marysue.ast import walk, transform
 from marysue.objects import Object
 from marysue.characters import Character, MarySue, TheOptimist
 from marysue.storytree import Story, Scene, EventSequence, Paragraph
@@ -12,6 +14,7 @@ from marysue.costume import (
 )
 
 
+@instrument.stage
 def edit_story(story, introduced, **kwargs):
     """Standard story-revising pipeline.  Takes a basic Story
     that was generated from a plot and returns a Story that is
@@ -26,25 +29,27 @@ def edit_story(story, introduced, **kwargs):
     ### Massage the generated story ###
 
     story = merge_adjacent_scenes(story)
-    story = resolve_setting_references(story)
 
-    ### Initialize story instant-states and context ###
+    # These happen in just two walks; see run_stages.
+    story = run_stages(story, [
+        SettingReferences(),
 
-    all_objects = set()
-    collect_objects(story, all_objects)
-    story = assign_empty_states(story, objects=all_objects)
+        ### Initialize story instant-states and context ###
 
-    ### Assign locations ###
+        EmptyStates(),
 
-    story = assign_locations(story)
+        ### Assign locations ###
 
-    ### Assign moods and duties ###
+        Locations(),
 
-    story = assign_moods(story)
-    story = remove_mood_modifier_events(story)
+        ### Assign moods and duties ###
 
-    story = assign_duties(story)
-    story = remove_duty_acquisition_events(story)
+        Moods(),
+        MoodModifierEventRemoval(),
+
+        Duties(),
+        DutyAcquisitionEventRemoval(),
+    ])
 
     ### Elaborate the story ###
 
@@ -62,7 +67,7 @@ def edit_story(story, introduced, **kwargs):
 
     story = assign_first_occurrence(story)
 
-    story = story.flatten()
+    story = instrument.run('flatten', story.__class__.flatten, story)
 
     story = split_into_paragraphs(story)
     story = assign_referents(story)
@@ -76,245 +81,366 @@ def edit_story(story, introduced, **kwargs):
 
 def show_state(ast, attr, cls):
     """Example usage: show_state(story, 'subject', StateDutyEvent)"""
-    for child in ast:
-        show_state(child, cls)
-    if isinstance(ast, cls):
-        print "%s state is: %r" % (attr, getattr(ast, attr))
-        print
+    for node in walk(ast):
+        if isinstance(node, cls):
+            print "%s state is: %r" % (attr, getattr(node, attr))
+            print
+
+
+# - - - - pass manager - - - -
+# Many of the editor stages only annotate the nodes of the story, one after
+# another, in story order.  Rather than each of them rebuilding the whole
+# tree (and cloning every State on it) in turn, run_stages fuses as many of
+# them as it can into one walk, in which each node is rebuilt, and each of
+# its States cloned, only once.
+
+
+class Stage(object):
+    """A stage of editing which run_stages can fuse with its neighbours.
+
+    An 'annotate' stage changes only the attributes of each node; a
+    'filter' stage may drop or replace nodes.  The rest of the class
+    attributes say what a stage depends on, so that run_stages knows what
+    it can fuse:
+
+    * `draws`: whether it draws random numbers -- only one stage in each
+      walk may, so that they are all still drawn in the same order;
+    * `watches`: classes of node whose presence matters to the stage;
+    * `drops`: classes of node which a filter may drop or replace;
+    * `reads` and `writes`: fields of State (besides `object`) that the
+      stage looks at, and sets.
+    """
 
+    kind = 'annotate'
+    draws = False
+    watches = ()
+    drops = ()
+    reads = ()
+    writes = ()
+
+    def enter(self, node, attrs, updates):
+        """Called on each node in story order.  `attrs` is a dict of the
+        node's attributes as the stages before this one left them, which
+        this may change.  `updates` maps roles to dicts of fields to set
+        on their States; once every annotator has seen the node, each State
+        is cloned with all of them at once.  So, no annotator in the walk
+        sees the fields set by another on the same node."""
+
+    def filter(self, node, attrs):
+        """Called on each node in story order, after the annotators.
+        Returns the node to keep it, None to drop it, or another node to
+        use in its place -- which should be made from `attrs`, as no stage
+        in the walk will see it."""
+        return node
+
+
+def fusable(walk, stage):
+    (annotators, filters) = walk
+    if stage.draws and any([s.draws for s in annotators + filters]):
+        return False
+    if stage.kind == 'filter':
+        return True
+    # the annotator would see each node before the walk's filters do
+    for dropped in [cls for f in filters for cls in f.drops]:
+        for watched in stage.watches:
+            if issubclass(watched, dropped) or issubclass(dropped, watched):
+                return False
+    # ...and wouldn't see what the walk's annotators set on the same node
+    for annotator in annotators:
+        if set(annotator.writes) & set(stage.reads):
+            return False
+    return True
+
+
+def schedule(stages):
+    """Groups the stages, in order, into walks, each of which is a pair of
+    a list of annotators and a list of filters to run after them."""
+    walks = []
+    for stage in stages:
+        if not walks or not fusable(walks[-1], stage):
+            walks.append(([], []))
+        walks[-1][0 if stage.kind == 'annotate' else 1].append(stage)
+    return walks
+
+
+def run_walk(ast, annotators, filters):
+    def enter(node):
+        attrs = dict(node.iteritems())
+        updates = {}
+        for stage in annotators:
+            stage.enter(node, attrs, updates)
+        for role, fields in updates.iteritems():
+            attrs[role] = attrs[role].clone(**fields)
+        for stage in filters:
+            result = stage.filter(node, attrs)
+            if result is not node:
+                return result
+        return (node, attrs)
+
+    name = '+'.join([stage.__class__.__name__ for stage in annotators + filters])
+    return instrument.run(name, transform, ast, enter)
+
+
+def run_stages(ast, stages):
+    """Runs the stages over the story tree, with the same result as running
+    each one over all of it in turn, but in as few walks as possible."""
+    for (annotators, filters) in schedule(stages):
+        ast = run_walk(ast, annotators, filters)
+    return ast
 
-# - - - - editor stages - - - -
 
-
-def collect_objects(ast, object_set):
-    """Places all the objects found in the given story tree into the given
-    object_set.  Does not return anything, modifies object_set instead."""
-    for child in ast:
-        collect_objects(child, object_set)
-    for key, value in ast.iteritems():
-        if isinstance(value, Object):
-            object_set.add(value)
+# - - - - editor stages - - - -
+# Some of these are Stages, which are only ever run through run_stages.  The
+# rest are written as an `enter` function for marysue.ast.transform, which
+# calls it on each node in story order; see there for what it returns.
 
 
-def assign_empty_states(ast, context=None, objects=None):
+class EmptyStates(Stage):
     """Replaces all Object references in a story tree with State objects
     which proxy for those Objects.  These State objects are initially
-    empty; further passes will make them reflect what's actually going on."""
+    empty; further passes will make them reflect what's actually going on.
 
-    if context is None:
-        context = dict((object, State(object)) for object in objects)
+    `context` maps each Object to its State; any Object not in it gets
+    a new State the first time it appears."""
 
-    attrs = {}
-    for key, value in ast.iteritems():
-        if isinstance(value, Object):
-            attrs[key] = context[value]
-        else:
-            attrs[key] = value
-    return ast.__class__(*[assign_empty_states(c, context=context) for c in ast], **attrs)
+    def __init__(self, context=None):
+        self.context = {} if context is None else context
 
+    def enter(self, node, attrs, updates):
+        for key, value in attrs.items():
+            if isinstance(value, Object):
+                state = self.context.get(value)
+                if state is None:
+                    state = self.context[value] = State(value)
+                attrs[key] = state
 
-def assign_locations(ast, context=None):
-    # And this is entirely so we can say "Her scarf shone in the dim light of the tunnel!"
 
-    if context is None:
-        context = {}
+class Locations(Stage):
+    # And this is entirely so we can say "Her scarf shone in the dim light of the tunnel!"
+    watches = (Scene,)
+    writes = ('location',)
 
-    if isinstance(ast, Scene):
-        context['location'] = ast.setting
+    def __init__(self, context=None):
+        self.context = {} if context is None else context
 
-    attrs = {}
-    for role, state in ast.iteritems():
-        if isinstance(state, State) and isinstance(state.object, Character):
-            state = state.clone(location=context['location'])
-        attrs[role] = state
+    def enter(self, node, attrs, updates):
+        if isinstance(node, Scene):
+            self.context['location'] = attrs['setting']
 
-    return ast.__class__(*[assign_locations(c, context=context) for c in ast], **attrs)
+        for role, state in attrs.iteritems():
+            if isinstance(state, State) and isinstance(state.object, Character):
+                updates.setdefault(role, {})['location'] = self.context['location']
 
 
+@instrument.stage
 def assign_costumes(ast, context=None):
     if context is None:
         context = {}
 
-    # reset costumes in each scene
-    if isinstance(ast, Scene):
-        context = {}
-
-    attrs = {}
-    for role, state in ast.iteritems():
-        if isinstance(state, State) and isinstance(state.object, Character):
-            character = state.object
-            if state.object not in context:
-                context[character] = {
-                    'feet': make_feet_costume(character),
-                }
-                if random.chance(66):
-                    context[character].update({
-                        'torso': make_torso_costume(character),
-                        'legs': make_legs_costume(character)
-                    })
-                else:
-                    context[character].update({
-                        'torso': make_onesie_costume(character),
-                        'legs': None
-                    })
-
-            entry = context[character]
-            state = state.clone(
-                torso_costume=entry['torso'],
-                legs_costume=entry['legs'],
-                feet_costume=entry['feet'],
-            )
-        attrs[role] = state
-
-    return ast.__class__(*[assign_costumes(c, context) for c in ast], **attrs)
-
-
-def assign_moods(ast, moods=None):
-    if moods is None:
-        moods = {}
-
-    if isinstance(ast, MoodModifierEvent):
-        moods[ast.subject.object] = ast.mood()
-
-    attrs = {}
-    for role, state in ast.iteritems():
-        if isinstance(state, State) and isinstance(state.object, Character):
-            character = state.object
-            if character not in moods:
-                print "ERROR", character, "appears before mood assigned, assuming happy"
-                moods[character] = 'happy'
-            if isinstance(character, TheOptimist):
-                # No, I'm not going to let it get me down!
-                moods[character] = 'happy'
-            state = state.clone(mood=moods[character])
-        attrs[role] = state
-
-    return ast.__class__(*[assign_moods(c, moods=moods) for c in ast], **attrs)
-
-
-def remove_mood_modifier_events(ast):
-    children = []
-    for child in ast:
-        if isinstance(child, MoodModifierEvent):
-            if random.chance(10) and isinstance(child.subject.object, TheOptimist) and child.mood() != 'happy':
-                children.append(CharacterStaysHappyEvent(subject=child.subject))
-        else:
-            children.append(remove_mood_modifier_events(child))
-
-    return ast.__class__(*children, **dict(ast.iteritems()))
-
-
-def assign_duties(ast, duties=None):
-    if duties is None:
-        duties = {}
-
-    if isinstance(ast, AcquireDutyEvent):
-        duties.setdefault(ast.subject.object, set()).add(ast.object.object)
-
-    if isinstance(ast, RelieveDutyEvent):
-        duties.setdefault(ast.subject.object, set())
-        if ast.object.object not in duties[ast.subject.object]:
-            print >>sys.stderr, '%r not in %r`s %r' % (
-                ast.object.object, ast.subject.object, duties[ast.subject.object]
-            )
-        else:
-            duties[ast.subject.object].remove(ast.object.object)
-
-    attrs = {}
-    for role, state in ast.iteritems():
-        if isinstance(state, State) and isinstance(state.object, Character):
-            character = state.object
-            if character not in duties:
-                duties[character] = set()
-            state = state.clone(duties=set(duties[character]))
-        attrs[role] = state
+    def enter(ast):
+        # reset costumes in each scene
+        if isinstance(ast, Scene):
+            context.clear()
+
+        attrs = {}
+        for role, state in ast.iteritems():
+            if isinstance(state, State) and isinstance(state.object, Character):
+                character = state.object
+                if state.object not in context:
+                    context[character] = {
+                        'feet': make_feet_costume(character),
+                    }
+                    if random.chance(66):
+                        context[character].update({
+                            'torso': make_torso_costume(character),
+                            'legs': make_legs_costume(character)
+                        })
+                    else:
+                        context[character].update({
+                            'torso': make_onesie_costume(character),
+                            'legs': None
+                        })
+
+                entry = context[character]
+                state = state.clone(
+                    torso_costume=entry['torso'],
+                    legs_costume=entry['legs'],
+                    feet_costume=entry['feet'],
+                )
+            attrs[role] = state
+        return (ast, attrs)
+
+    return transform(ast, enter)
+
+
+class Moods(Stage):
+    watches = (MoodModifierEvent,)
+    writes = ('mood',)
+
+    def __init__(self, moods=None):
+        self.moods = {} if moods is None else moods
+
+    def enter(self, node, attrs, updates):
+        moods = self.moods
+        if isinstance(node, MoodModifierEvent):
+            moods[attrs['subject'].object] = node.mood()
+
+        for role, state in attrs.iteritems():
+            if isinstance(state, State) and isinstance(state.object, Character):
+                character = state.object
+                if character not in moods:
+                    print "ERROR", character, "appears before mood assigned, assuming happy"
+                    moods[character] = 'happy'
+                if isinstance(character, TheOptimist):
+                    # No, I'm not going to let it get me down!
+                    moods[character] = 'happy'
+                updates.setdefault(role, {})['mood'] = moods[character]
+
+
+class MoodModifierEventRemoval(Stage):
+    kind = 'filter'
+    draws = True
+    drops = (MoodModifierEvent,)
+
+    def filter(self, node, attrs):
+        if isinstance(node, MoodModifierEvent):
+            subject = attrs['subject']
+            if random.chance(10) and isinstance(subject.object, TheOptimist) and node.mood() != 'happy':
+                return CharacterStaysHappyEvent(subject=subject)
+            return None
+        return node
+
+
+class Duties(Stage):
+    watches = (AcquireDutyEvent, RelieveDutyEvent)
+    writes = ('duties',)
+
+    def __init__(self, duties=None):
+        self.duties = {} if duties is None else duties
+
+    def enter(self, node, attrs, updates):
+        duties = self.duties
+        if isinstance(node, AcquireDutyEvent):
+            duties.setdefault(attrs['subject'].object, set()).add(attrs['object'].object)
+
+        if isinstance(node, RelieveDutyEvent):
+            subject = attrs['subject'].object
+            object = attrs['object'].object
+            duties.setdefault(subject, set())
+            if object not in duties[subject]:
+                print >>sys.stderr, '%r not in %r`s %r' % (
+                    object, subject, duties[subject]
+                )
+            else:
+                duties[subject].remove(object)
 
-    return ast.__class__(*[assign_duties(c, duties=duties) for c in ast], **attrs)
+        for role, state in attrs.iteritems():
+            if isinstance(state, State) and isinstance(state.object, Character):
+                character = state.object
+                if character not in duties:
+                    duties[character] = set()
+                updates.setdefault(role, {})['duties'] = set(duties[character])
 
 
-def remove_duty_acquisition_events(ast):
-    children = []
-    for child in ast:
-        if not isinstance(child, (AcquireDutyEvent, RelieveDutyEvent)):
-            children.append(remove_duty_acquisition_events(child))
+class DutyAcquisitionEventRemoval(Stage):
+    kind = 'filter'
+    drops = (AcquireDutyEvent, RelieveDutyEvent)
 
-    return ast.__class__(*children, **dict(ast.iteritems()))
+    def filter(self, node, attrs):
+        if isinstance(node, (AcquireDutyEvent, RelieveDutyEvent)):
+            return None
+        return node
 
 
+@instrument.stage
 def assign_referents(ast, context=None):
     if context is None:
         context = {'referent': None}
 
-    # reset referent in each... eventually this will be paragraph
-    #if isinstance(ast, Turn):
-    #    context['referent'] = None
-
-    attrs = {}
-    for role, state in ast.iteritems():
-        if isinstance(state, State):
-            attrs[role] = state.clone(is_referent=(state.object == context['referent']))
-            if role == 'subject':
-                context['referent'] = state.object
-        else:
-            attrs[role] = state
+    def enter(ast):
+        # reset referent in each... eventually this will be paragraph
+        #if isinstance(ast, Turn):
+        #    context['referent'] = None
+
+        attrs = {}
+        for role, state in ast.iteritems():
+            if isinstance(state, State):
+                attrs[role] = state.clone(is_referent=(state.object == context['referent']))
+                if role == 'subject':
+                    context['referent'] = state.object
+            else:
+                attrs[role] = state
+        return (ast, attrs)
 
-    return ast.__class__(*[assign_referents(c, context) for c in ast], **attrs)
+    return transform(ast, enter)
 
 
-def resolve_setting_references(ast, setting=None):
-    if isinstance(ast, Scene):
-        setting = ast.setting
+class SettingReferences(Stage):
+    """Points each PoseDescription at the scenery of the setting it is in."""
+    draws = True
+    watches = (Scene, PoseDescription)
 
-    attrs = dict((k, v) for (k, v) in ast.iteritems())
+    def __init__(self, setting=None):
+        self.setting = setting
 
-    if isinstance(ast, PoseDescription):
-        attrs['object'] = State(setting.nearby_scenery)
+    def enter(self, node, attrs, updates):
+        if isinstance(node, Scene):
+            self.setting = attrs['setting']
 
-    return ast.__class__(*[resolve_setting_references(c, setting=setting) for c in ast], **attrs)
+        if isinstance(node, PoseDescription):
+            attrs['object'] = State(self.setting.nearby_scenery)
 
 
+@instrument.stage
 def assign_first_occurrence(ast, occurred=None):
     """We use this to select between definite and indefinite article"""
     # TODO: mentioning in dialogue does not count as first occurrence
     if occurred is None:
         occurred = set()
 
-    attrs = {}
-    for role, state in ast.iteritems():
-        # first of these is to avoid counting objects in Scene, etc as occurrence
-        if isinstance(ast, Event) and isinstance(state, State):
-            if state.object not in occurred:
-                state = state.clone(first_occurrence=True)
-                occurred.add(state.object)
-        attrs[role] = state
+    def enter(ast):
+        attrs = {}
+        for role, state in ast.iteritems():
+            # first of these is to avoid counting objects in Scene, etc as occurrence
+            if isinstance(ast, Event) and isinstance(state, State):
+                if state.object not in occurred:
+                    state = state.clone(first_occurrence=True)
+                    occurred.add(state.object)
+            attrs[role] = state
+        return (ast, attrs)
 
-    return ast.__class__(*[assign_first_occurrence(c, occurred=occurred) for c in ast], **attrs)
+    return transform(ast, enter)
 
 
+@instrument.stage
 def describe_scene(ast):
-    children = [c for c in ast]
-
-    if isinstance(ast, Scene):
-        children = [EventSequence(
-            SettingDescription(
-                subject=ast.setting
-            ),
-            NearbyDescription(
-                subject=ast.setting,
-                object=State(
-                    object=ast.setting.nearby_scenery,
-                    location=ast.setting
-                )
-            ),
-            GenericSettingDescription(
-                subject=ast.setting,
-            ),
-            EventSequence(*children)
-        )]
+    def enter(ast):
+        children = [c for c in ast]
+
+        if isinstance(ast, Scene):
+            children = [EventSequence(
+                SettingDescription(
+                    subject=ast.setting
+                ),
+                NearbyDescription(
+                    subject=ast.setting,
+                    object=State(
+                        object=ast.setting.nearby_scenery,
+                        location=ast.setting
+                    )
+                ),
+                GenericSettingDescription(
+                    subject=ast.setting,
+                ),
+                EventSequence(*children)
+            )]
 
-    return ast.__class__(*[describe_scene(c) for c in children], **dict(ast.iteritems()))
+        return (children, dict(ast.iteritems()))
 
+    return transform(ast, enter)
 
+
+@instrument.stage
 def describe_characters(ast, described, newly_introduced):
     """Describes them as if we are meeting them for the first time.
     `described` is a set of characters who have already been described.
@@ -325,74 +451,87 @@ def describe_characters(ast, described, newly_introduced):
     appearance overmuch.
     """
 
-    if isinstance(ast, Event):
-        if isinstance(ast.subject, State) and isinstance(ast.subject.object, Character):
-            if ast.subject.object not in described:
-                if isinstance(ast.subject.object, MarySue) or random.chance(50):
-                    described.add(ast.subject.object)
-                    newly_introduced.add(ast.subject.object)
-                    return EventSequence(
-                        ast,
-                        CharacterDescription(subject=ast.subject),
-                        CharacterFeaturesDescription(subject=ast.subject)
-                    )
+    def enter(ast):
+        if isinstance(ast, Event):
+            if isinstance(ast.subject, State) and isinstance(ast.subject.object, Character):
+                if ast.subject.object not in described:
+                    if isinstance(ast.subject.object, MarySue) or random.chance(50):
+                        described.add(ast.subject.object)
+                        newly_introduced.add(ast.subject.object)
+                        return EventSequence(
+                            ast,
+                            CharacterDescription(subject=ast.subject),
+                            CharacterFeaturesDescription(subject=ast.subject)
+                        )
 
-    return ast.__class__(*[describe_characters(c, described, newly_introduced) for c in ast], **dict(ast.iteritems()))
+        return (ast, dict(ast.iteritems()))
 
+    return transform(ast, enter)
 
+
+@instrument.stage
 def remind_characters(ast, reminded):
     """Describes them assuming we have already been introduced to them,
     by subtly (hah) reminding us about what they look like."""
 
-    if isinstance(ast, Event):
-        if isinstance(ast.subject, State) and isinstance(ast.subject.object, Character):
-            if ast.subject.object not in reminded:
-                if random.chance(20):
-                    reminded.add(ast.subject.object)
-                    return EventSequence(
-                        ast,
-                        CharacterReminder(subject=ast.subject),
-                    )
+    def enter(ast):
+        if isinstance(ast, Event):
+            if isinstance(ast.subject, State) and isinstance(ast.subject.object, Character):
+                if ast.subject.object not in reminded:
+                    if random.chance(20):
+                        reminded.add(ast.subject.object)
+                        return EventSequence(
+                            ast,
+                            CharacterReminder(subject=ast.subject),
+                        )
 
-    return ast.__class__(*[remind_characters(c, reminded) for c in ast], **dict(ast.iteritems()))
+        return (ast, dict(ast.iteritems()))
 
+    return transform(ast, enter)
 
+
+@instrument.stage
 def describe_costumes(ast, described=None):
     if described is None:
         described = set()
 
-    if isinstance(ast, Scene):
-        described = set()
+    def enter(ast):
+        if isinstance(ast, Scene):
+            described.clear()
 
-    if isinstance(ast, Event):
-        if isinstance(ast.subject, State) and isinstance(ast.subject.object, Character):
-            if ast.subject.object not in described:
-                if isinstance(ast.subject.object, MarySue) or random.chance(50):
-                    described.add(ast.subject.object)
-                    return EventSequence(
-                        ast,
-                        TorsoCostumeReminder(subject=ast.subject) if random.chance(10) else TorsoCostumeDescription(subject=ast.subject),
-                        FeetCostumeReminder(subject=ast.subject) if random.chance(10) else FeetCostumeDescription(subject=ast.subject)
-                    )
+        if isinstance(ast, Event):
+            if isinstance(ast.subject, State) and isinstance(ast.subject.object, Character):
+                if ast.subject.object not in described:
+                    if isinstance(ast.subject.object, MarySue) or random.chance(50):
+                        described.add(ast.subject.object)
+                        return EventSequence(
+                            ast,
+                            TorsoCostumeReminder(subject=ast.subject) if random.chance(10) else TorsoCostumeDescription(subject=ast.subject),
+                            FeetCostumeReminder(subject=ast.subject) if random.chance(10) else FeetCostumeDescription(subject=ast.subject)
+                        )
 
-    return ast.__class__(*[describe_costumes(c, described=described) for c in ast], **dict(ast.iteritems()))
+        return (ast, dict(ast.iteritems()))
+
+    return transform(ast, enter)
 
 
 def collect_objects_from_states(ast, object_set):
-    for child in ast:
-        collect_objects_from_states(child, object_set)
-    for key, value in ast.iteritems():
-        if isinstance(value, State):
-            object_set.add(value.object)
+    for node in walk(ast):
+        for key, value in node.iteritems():
+            if isinstance(value, State):
+                object_set.add(value.object)
 
 
 def add_crickets(ast):
-    if isinstance(ast, LookAtEvent):
-        return EventSequence(ast, CricketsEvent())
+    def enter(ast):
+        if isinstance(ast, LookAtEvent):
+            return EventSequence(ast, CricketsEvent())
+        return (ast, dict(ast.iteritems()))
 
-    return ast.__class__(*[add_crickets(c) for c in ast], **dict(ast.iteritems()))
+    return transform(ast, enter)
 
 
+@instrument.stage
 def merge_adjacent_scenes(ast):
     children = []
     for child in ast:
@@ -408,8 +547,12 @@ def merge_adjacent_scenes(ast):
     return ast.__class__(*children, **dict(ast.iteritems()))
 
 
+@instrument.stage
 def split_into_paragraphs(ast):
-    if isinstance(ast, Scene):
+    def enter(ast):
+        if not isinstance(ast, Scene):
+            return (ast, dict(ast.iteritems()))
+
         assert len([c for c in ast]) == 1
         eseq = ast[0]
         assert isinstance(eseq, EventSequence)
@@ -437,14 +580,17 @@ def split_into_paragraphs(ast):
             children.append(parachilds)
 
         children = [EventSequence(*[Paragraph(*r) for r in children])]
-    else:
-        children = [split_into_paragraphs(c) for c in ast]
+        return ast.__class__(*children, **dict(ast.iteritems()))
 
-    return ast.__class__(*children, **dict(ast.iteritems()))
+    return transform(ast, enter)
 
 
+@instrument.stage
 def conjoin_sentences(ast):
-    if isinstance(ast, Paragraph):
+    def enter(ast):
+        if not isinstance(ast, Paragraph):
+            return (ast, dict(ast.iteritems()))
+
         children = []
         for child in ast:
             if not children or \
@@ -456,7 +602,6 @@ def conjoin_sentences(ast):
                 last = children[-1]
                 compound = ConjoinedEvent(event1=last, event2=child)
                 children[-1] = compound
-    else:
-        children = [conjoin_sentences(c) for c in ast]
+        return ast.__class__(*children, **dict(ast.iteritems()))
 
-    return ast.__class__(*children, **dict(ast.iteritems()))
+    return transform(ast, enter)
@@ -1,26 +1,36 @@
+from collections import OrderedDict
+
 import marysue.util as random
-from marysue.ast import AST
+from marysue.ast import AST, Slotted
 
 
 # - - - -
 
 
+class EventClass(Slotted):
+    """Metaclass for events, which works out, once per class, whether
+    its events can be conjoined -- instead of conjoin_sentences looking
+    through the templates of every single event it sees."""
+
+    def __init__(cls, name, bases, dict_):
+        super(EventClass, cls).__init__(name, bases, dict_)
+        if 'templates' in dict_ and 'is_conjoinable' not in dict_:
+            cls.is_conjoinable = bool(cls.templates) and not any(
+                [t[0] in ('"', "'") for t in cls.templates]
+            )
+
+
 class Event(AST):
+    __metaclass__ = EventClass
+    registry = OrderedDict()
     exciting = False
     new_para = False
+    is_conjoinable = False
     slots = (
         'subject', 'object',
         'object2',  # rarely used
     )
 
-    @property
-    def is_conjoinable(self):
-        if not self.templates:
-            return False
-        if any([t[0] in ('"', "'") for t in self.templates]):
-            return False
-        return True
-
 
 # - - - - mood modifier events
 
@@ -28,7 +38,8 @@ class Event(AST):
 class MoodModifierEvent(Event):
     def __init__(self, subject, **kwargs):
         # this is just to debug where we might be constructing it with wrong args
-        assert subject is not None
+        if random.validating():
+            assert subject is not None
         super(MoodModifierEvent, self).__init__(subject=subject, **kwargs)
 
     def mood(self):
@@ -913,9 +924,8 @@ class ConjoinedEvent(Event):
 
 
 def get_event_class(name):
-    cls = globals().get(name)
-    return cls
+    return Event.registry.get(name)
 
 
 def get_all_event_classes():
-    return [c for c in globals().values() if c.__class__ == type and issubclass(c, Event)]
+    return Event.registry.values()
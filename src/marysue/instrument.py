@@ -0,0 +1,151 @@
+"""Instrumentation of the stages of generating a chapter.
+
+Each time a stage (a function decorated with `stage`, or one called through
+`run`) is run while this thread has any `hooks()`, each hook is called with
+a record of it: a dict giving the stage's name, how deeply it was nested in
+other stages, how long it took, how many nodes the trees it was given and
+gave back had, and how many States were cloned while it ran.  (Counting the
+nodes takes time too, which is left out of the times of the stages it
+happens inside.)  If tracemalloc is tracing (e.g. PYTHONTRACEMALLOC is set,
+on a Python that has it), the record also gives how many more bytes were
+allocated when it finished.
+
+A Report is a hook which collects the records into a JSON-able dict.
+When there are no hooks, stages cost only an extra function call.
+"""
+
+import json
+import threading
+import time
+from functools import wraps
+
+try:
+    import tracemalloc
+except ImportError:  # not in Python 2
+    tracemalloc = None
+
+from marysue.ast import AST, walk
+from marysue.state import State
+
+
+local = threading.local()
+
+
+def hooks():
+    if not hasattr(local, 'hooks'):
+        local.hooks = []
+        local.depth = 0
+        local.counting = 0.0  # seconds spent counting nodes, in all
+    return local.hooks
+
+
+def count_nodes(values):
+    """Counts the nodes of all the trees in `values`, which may also be
+    lists or tuples of them; returns None if there are none at all."""
+    count = None
+    for value in values:
+        if isinstance(value, AST):
+            count = (count or 0) + sum(1 for node in walk(value))
+        elif isinstance(value, (list, tuple)):
+            n = count_nodes(value)
+            if n is not None:
+                count = (count or 0) + n
+    return count
+
+
+def count_nodes_untimed(values):
+    start = time.time()
+    count = count_nodes(values)
+    local.counting += time.time() - start
+    return count
+
+
+def traced_memory():
+    if tracemalloc is None or not tracemalloc.is_tracing():
+        return None
+    return tracemalloc.get_traced_memory()[0]
+
+
+def run(name, f, *args, **kwargs):
+    """Returns f(*args, **kwargs), recording it as the stage `name`."""
+    if not hooks():
+        return f(*args, **kwargs)
+
+    record = {
+        'stage': name,
+        'depth': local.depth,
+        'nodes_in': count_nodes_untimed(args),
+    }
+    clones = State.clones
+    allocated = traced_memory()
+    counting = local.counting
+    start = time.time()
+    local.depth += 1
+    try:
+        result = f(*args, **kwargs)
+    finally:
+        local.depth -= 1
+    record['seconds'] = time.time() - start - (local.counting - counting)
+    record['state_clones'] = State.clones - clones
+    if allocated is not None:
+        record['allocated'] = traced_memory() - allocated
+    record['nodes_out'] = count_nodes_untimed((result,))
+
+    for hook in list(hooks()):
+        hook(record)
+    return result
+
+
+def stage(f):
+    """Decorator which makes every call of `f` a stage named after it."""
+    @wraps(f)
+    def instrumented(*args, **kwargs):
+        return run(f.__name__, f, *args, **kwargs)
+    return instrumented
+
+
+class Report(object):
+    """Collects the records of all the stages run while it is in use, as in
+
+        with Report(chapter=3) as report:
+            ...
+        print report.to_json()
+
+    Whatever keyword arguments it is given are included in the report."""
+
+    def __init__(self, **info):
+        self.info = info
+        self.records = []
+
+    def __call__(self, record):
+        self.records.append(record)
+
+    def __enter__(self):
+        hooks().append(self)
+        self.counting = local.counting
+        self.start = time.time()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.seconds = time.time() - self.start - (local.counting - self.counting)
+        hooks().remove(self)
+
+    def as_dict(self):
+        """Records are listed in the order the stages finished in, so each
+        comes after all the stages nested in it.  Also totals up, for
+        each stage name, how many times it ran and how long it took."""
+        totals = {}
+        for record in self.records:
+            total = totals.setdefault(record['stage'], {'calls': 0, 'seconds': 0.0})
+            total['calls'] += 1
+            total['seconds'] += record['seconds']
+        report = dict(self.info)
+        report.update({
+            'seconds': self.seconds,
+            'stages': self.records,
+            'totals': totals,
+        })
+        return report
+
+    def to_json(self):
+        return json.dumps(self.as_dict(), sort_keys=True)
@@ -1,5 +1,7 @@
+from collections import OrderedDict
+
 import marysue.util as random
-from marysue.ast import AST
+from marysue.ast import AST, flattened_children
 from marysue.storytree import EventSequence
 from marysue.events import *
 from marysue.duties import RescueDuty, RetrieveDuty
@@ -7,6 +9,8 @@ from marysue.characters import Character, TheOptimist, MarySue
 
 
 class Plot(AST):
+    __slots__ = ('class_counts',)
+    registry = OrderedDict()
     slots = (
         'subject',        # often a Group instead of a single character
         'object',         # usually a single characters
@@ -18,6 +22,24 @@ class Plot(AST):
         'setting',        # the current setting
     )
 
+    def __init__(self, *args, **kwargs):
+        super(Plot, self).__init__(*args, **kwargs)
+        # How many times each plot class occurs in this (sub)plot, counting
+        # this node itself.  Built from the children's counts, so it costs
+        # only a little more than building the node.
+        class_counts = {}
+        for child in self:
+            if isinstance(child, Plot):
+                for cls, count in child.class_counts.iteritems():
+                    class_counts[cls] = class_counts.get(cls, 0) + count
+        for cls in self.__class__.__mro__:
+            if issubclass(cls, Plot):
+                class_counts[cls] = class_counts.get(cls, 0) + 1
+        self.class_counts = class_counts
+
+    def count_class(self, cls):
+        return self.class_counts.get(cls, 0)
+
 
 class PlotSequence(Plot):
     """Acts as a container for (sub)sequences of PlotDevelopments."""
@@ -37,12 +59,7 @@ class PlotSequence(Plot):
         return self.__class__(*list(self.all_children()), **dict(self.iteritems()))
 
     def all_children(self):
-        for child in self:
-            if isinstance(child, self.__class__):
-                for descendant in child.all_children():
-                    yield descendant
-            else:
-                yield child
+        return flattened_children(self, self.__class__)
 
 
 class PlotDevelopment(Plot):
@@ -655,16 +672,12 @@ class DreamSequence(PlotDevelopment):
 
 
 def all_plot_classes():
-    return [
-        c for c in globals().values() if c.__class__ == type and
-                                         issubclass(c, Plot) and
-                                         c != Plot
-    ]
+    return [c for c in Plot.registry.values() if c is not Plot]
 
 
 def get_plot_class(name):
     try:
-        return globals()[name]
+        return Plot.registry[name]
     except KeyError:
         for cls in all_plot_classes():
             print cls.__name__
@@ -1,4 +1,8 @@
+from collections import OrderedDict
+
+import marysue.instrument as instrument
 from marysue.util import log
+from marysue.ast import Registered, transform
 from marysue.storytree import Story, Scene, EventSequence
 from marysue.events import *
 from marysue.objects import Group
@@ -37,11 +41,19 @@ class InapplicableRuleError(ValueError):
 
 
 class PlotRewritingRule(object):
+    __metaclass__ = Registered
+    registry = OrderedDict()
+
     def assign_participants(self, plotter, plot_hole, unavailable):
         """plotter is the Plotter object that is applying this rule.
 
         plot_hole is the PlotHole that is being rewritten into a (sub)plot.
 
+        Returns False if the rule cannot be applied here.  Whether it can
+        must depend only on the plotter, the setting, and what's unavailable,
+        and must be decided before any random choices are made -- the
+        Plotter remembers which rules failed, and won't try them again.
+
         """
         self.plotter = plotter
         self.plot_hole = plot_hole
@@ -71,22 +83,23 @@ class PlotRewritingRule(object):
         if filter is None:
             filter = lambda x: True
         eligible = set([x for x in self.protagonists if filter(x)])
-        if not eligible:
+        # need p1 and at least one other
+        if not eligible or len(self.protagonists) < 2:
             raise InapplicableRuleError
         self.p1 = random.choice(eligible)
         self.others = set(self.protagonists)
         self.others.remove(self.p1)
-        if not self.others:
-            raise InapplicableRuleError
 
     def pick_antagonist(self):
         self.a1 = random.choice(self.plotter.antagonists)
 
-    def pick_macguffin(self):
-        eligible = set(self.plotter.macguffins) - self.unavailable
-        if not eligible:
+    def compute_macguffins(self):
+        self.macguffins = set(self.plotter.macguffins) - self.unavailable
+        if not self.macguffins:
             raise InapplicableRuleError
-        self.m1 = random.choice(eligible)
+
+    def pick_macguffin(self):
+        self.m1 = random.choice(self.macguffins)
 
     def pick_mary_sue_and_dreamboat(self):
         self.mary_sues = tuple([p for p in self.protagonists if isinstance(p, MarySue)])
@@ -206,6 +219,7 @@ class FindAnotherWayRule(PlotRewritingRule):
 class LostItemRule(PlotRewritingRule):
     def assign_participants_impl(self):
         self.compute_protagonists()
+        self.compute_macguffins()
         self.pick_protagonist_and_others()
         self.pick_macguffin()
         self.mary_sues = tuple([p for p in self.protagonists if isinstance(p, MarySue)])
@@ -486,9 +500,8 @@ class DroneRule(PlotRewritingRule):
 
 def all_rules():
     return [
-        c for c in globals().values() if c.__class__ == type and
-                                         issubclass(c, PlotRewritingRule) and
-                                         c != PlotRewritingRule
+        c for c in PlotRewritingRule.registry.values()
+        if c is not PlotRewritingRule
     ]
 
 
@@ -504,56 +517,92 @@ class Plotter(object):
         self.macguffins = tuple(macguffins)
         self.settings = tuple(settings)
         self.home = self.settings[0]
-
-    def fill_plot_hole(self, plot_hole, unavailable):
-        generators = [cls() for cls in plot_hole.rules]
-        generators = [
-            g for g in generators
-            if g.assign_participants(self, plot_hole, unavailable)
-        ]
-        if not generators:
-            #print "no applicable plot rule found!"
-            return plot_hole
-        else:
-            # NOTE: must be tuple()!  Not set()!  Much badness with set()!
-            # (It's because these Rule objects are not hashable/immutable.)
-            generators = tuple(generators)
-            return random.choice(generators).generate(self)
-
-    def complicate_plot(self, plot, unavailable=None):
+        # (rule class, setting, frozenset of unavailable) for each rule
+        # that turned out to be inapplicable in that situation
+        self.inapplicable = set()
+
+    def fill_plot_hole(self, plot_hole, unavailable, counts=None, plot_max=()):
+        """If `counts` is given, it should be a dict mapping each class
+        constrained by `plot_max` to the number of occurrences of that class
+        currently in the plot.  Rules whose subplot would exceed one of these
+        maximums are not used, and `counts` is updated with whatever the
+        chosen rule does add to the plot."""
+        frozen_unavailable = frozenset(unavailable)
+        generators = []
+        for cls in plot_hole.rules:
+            key = (cls, plot_hole.setting, frozen_unavailable)
+            if key in self.inapplicable:
+                continue
+            g = cls()
+            if g.assign_participants(self, plot_hole, unavailable):
+                generators.append(g)
+            else:
+                self.inapplicable.add(key)
+        # NOTE: must be tuple()!  Not set()!  Much badness with set()!
+        # (It's because these Rule objects are not hashable/immutable.)
+        generators = tuple(generators)
+        while generators:
+            generator = random.choice(generators)
+            subplot = generator.generate(self)
+            if counts is None or not plot_max:
+                return subplot
+            added = dict(
+                (cls, self.count_plot_classes(subplot, cls)) for (cls, max) in plot_max
+            )
+            if all(counts[cls] + added[cls] <= max for (cls, max) in plot_max):
+                for cls, n in added.iteritems():
+                    counts[cls] += n
+                return subplot
+            generators = tuple(g for g in generators if g is not generator)
+        #print "no applicable plot rule found!"
+        return plot_hole
+
+    @instrument.stage
+    def complicate_plot(self, plot, unavailable=None, counts=None, plot_max=()):
         if unavailable is None:
             unavailable = set()
 
-        if isinstance(plot, PlotHole):
-            return self.fill_plot_hole(plot, unavailable)
+        def enter(plot):
+            if isinstance(plot, PlotHole):
+                return self.fill_plot_hole(
+                    plot, unavailable, counts=counts, plot_max=plot_max
+                )
+
+            if plot.disqualified:
+                unavailable.add(plot.disqualified)
+            if plot.requalified:
+                unavailable.remove(plot.requalified)
 
-        if plot.disqualified:
-            unavailable.add(plot.disqualified)
-        if plot.requalified:
-            unavailable.remove(plot.requalified)
+            return (plot, dict(plot.iteritems()))
 
-        children = [
-            self.complicate_plot(c, unavailable=unavailable) for c in plot
-        ]
-        return plot.__class__(*children, **dict(plot.iteritems()))
+        return transform(plot, enter)
 
     # - - - -
 
-    def remove_plot_holes(self, plot):
-        if isinstance(plot, PlotHole):
-            raise ValueError
-
-        children = [
-            self.remove_plot_holes(c) for c in plot if not isinstance(c, PlotHole)
-        ]
-        return plot.__class__(*children, **dict(plot.iteritems()))
-
-    def commute_commutable_plots(self, plot):
-        # requires flat plot
-        children = []
-        for child in plot:
-            if children:
-                last_scene = children[-1]
+    # These revisions are applied to the plot after it has been complicated.
+    # Each one takes an iterable of plot developments, in story order, and
+    # is a generator of the revised plot developments, looking back at most
+    # one plot development; chained together, they revise the whole plot in
+    # a single left-to-right pass.
+
+    def remove_plot_holes(self, plot_points):
+        for plot_point in plot_points:
+            if not isinstance(plot_point, PlotHole):
+                yield plot_point
+
+    def remove_repetitive_plots(self, plot_points):
+        last_scene = None
+        for child in plot_points:
+            # other possibilities: ContemplateRock
+            if isinstance(last_scene, AwkwardTension) and isinstance(child, AwkwardTension):
+                continue
+            last_scene = child
+            yield child
+
+    def commute_commutable_plots(self, plot_points):
+        last_scene = None
+        for child in plot_points:
+            if last_scene is not None:
                 if last_scene.setting == child.setting and \
                    isinstance(last_scene, (Rescue, RecoverItem)) and \
                    isinstance(child, (Rescue, RecoverItem)):
@@ -567,33 +616,18 @@ class Plotter(object):
                              child.__class__.__name__,
                              child.object.definite)
                         )
-                        children[-1] = child
-                        child = last_scene
-            children.append(child)
-
-        return plot.__class__(*[self.commute_commutable_plots(c) for c in children], **dict(plot.iteritems()))
-
-    def remove_repetitive_plots(self, plot):
-        # requires flat plot
-        children = []
-        for child in plot:
-            add_it = True
-            if children:
-                last_scene = children[-1]
-                # other possibilities: ContemplateRock
-                if isinstance(last_scene, AwkwardTension) and isinstance(child, AwkwardTension):
-                    add_it = False
-            if add_it:
-                children.append(child)
-
-        return plot.__class__(*children, **dict(plot.iteritems()))
-
-    def add_journeys(self, plot):
-        # requires flat plot
-        children = []
-        for child in plot:
-            if children:
-                last_scene = children[-1]
+                        # last_scene stays last, and may commute again
+                        yield child
+                        continue
+                yield last_scene
+            last_scene = child
+        if last_scene is not None:
+            yield last_scene
+
+    def add_journeys(self, plot_points):
+        last_scene = None
+        for child in plot_points:
+            if last_scene is not None:
                 if not isinstance(last_scene, Journey) and last_scene.setting != child.setting:
                     travellers = last_scene.exeunt
                     if not travellers:
@@ -610,88 +644,72 @@ class Plotter(object):
                                 travellers.append(s)
                         elif last_scene.subject:
                             travellers.append(last_scene.subject)
-                    children.append(Journey(
+                    yield Journey(
                         subject=Group(*travellers),
-                        setting=children[-1].setting,
+                        setting=last_scene.setting,
                         object=child.setting,
-                    ))
-            children.append(child)
-
-        return plot.__class__(*children, **dict(plot.iteritems()))
-
-    def encounter_new_settings(self, plot, context=None):
-        # rerquires flat plot (for reasons which are not *very* good)
-        if context is None:
-            context = {
-                'setting': plot.setting,
-                'seen': set([self.home]),
-                'unavailable': set(),
-            }
-
-        if plot.disqualified:
-            context['unavailable'].add(plot.disqualified)
-        if plot.requalified:
-            context['unavailable'].remove(plot.requalified)
-
-        available = set(self.protagonists) - context['unavailable']
-
-        if available and plot.setting != context['setting'] and \
-           plot.setting not in context['seen']:
-            context['setting'] = plot.setting
-            context['seen'].add(plot.setting)
-            plot = PlotSequence(
-                EncounterNewSetting(
+                    )
+            yield child
+            last_scene = child
+
+    def encounter_new_settings(self, plot_points):
+        setting = None
+        seen = set([self.home])
+        unavailable = set()
+        for plot in plot_points:
+            if plot.disqualified:
+                unavailable.add(plot.disqualified)
+            if plot.requalified:
+                unavailable.remove(plot.requalified)
+
+            available = set(self.protagonists) - unavailable
+
+            if available and plot.setting != setting and \
+               plot.setting not in seen:
+                setting = plot.setting
+                seen.add(plot.setting)
+                yield EncounterNewSetting(
                     subject=Group(*list(available)),
                     setting=plot.setting,
-                ),
-                plot,
-            )
-            return plot
-
-        children = [self.encounter_new_settings(c, context=context) for c in plot]
-        return plot.__class__(*children, **dict(plot.iteritems()))
-
-    def find_chekovs_guns(self, plot, gun_holders):
-        if isinstance(plot, LoseItem):
-            if plot.object not in gun_holders:
-                gun_holders.setdefault(plot.object, set()).add(plot.subject)
-
-        for child in plot:
-            self.find_chekovs_guns(child, gun_holders)
-
-    def add_chekovs_gun(self, plot, holder, chekovs_gun):
-        if isinstance(plot, Introduction):
-            others = set(plot.subject)
-            others.remove(holder)
-            return PlotSequence(
-                plot,
-                ChekovsGun(
-                    subject=holder,
-                    object=chekovs_gun,
-                    bystanders=Group(*list(others)),
-                    setting=plot.setting
                 )
-            )
-        elif not self.added_chekovs_fun and isinstance(plot, Convalescence):
-            self.added_chekovs_fun = True
-            others = set(plot.subject)
-            others.remove(holder)
-            return PlotSequence(
-                plot,
-                ChekovsFun(
+            yield plot
+
+    def add_chekovs_guns(self, plot_points, chekovs_guns):
+        """`chekovs_guns` is a list of (holder, chekovs_gun) pairs.  Each of
+        them is foreshadowed after the Introduction (the last one first),
+        and the first of them is brought up again after the Convalescence."""
+        added_chekovs_fun = False
+        for plot in plot_points:
+            yield plot
+            if isinstance(plot, Introduction):
+                for holder, chekovs_gun in reversed(chekovs_guns):
+                    others = set(plot.subject)
+                    others.remove(holder)
+                    yield ChekovsGun(
+                        subject=holder,
+                        object=chekovs_gun,
+                        bystanders=Group(*list(others)),
+                        setting=plot.setting
+                    )
+            elif chekovs_guns and not added_chekovs_fun and isinstance(plot, Convalescence):
+                added_chekovs_fun = True
+                holder, chekovs_gun = chekovs_guns[0]
+                others = set(plot.subject)
+                others.remove(holder)
+                yield ChekovsFun(
                     subject=holder,
                     object=chekovs_gun,
                     bystanders=Group(*list(others)),
                     setting=plot.setting
                 )
-            )
-        else:
-            children = [self.add_chekovs_gun(c, holder, chekovs_gun) for c in plot]
-            return plot.__class__(*children, **dict(plot.iteritems()))
 
     # - - - -
 
-    def write_plot(self, depth=5):
+    @instrument.stage
+    def write_plot(self, depth=5, plot_max=()):
+        """If `plot_max` is given, rules which would make the plot contain
+        more than the allowed number of occurrences of a plot class are
+        not applied while complicating the plot."""
         home = self.home
         plot = PlotSequence(
             Introduction(
@@ -718,35 +736,42 @@ class Plotter(object):
             )
         )
 
-        # we flatten the plot frequently to help stay under max recursion depth
-        for i in xrange(0, depth):
-            plot = self.complicate_plot(plot)
-            plot = plot.flatten()
-        plot = self.remove_plot_holes(plot)
-        plot = plot.flatten()
-        plot = self.remove_repetitive_plots(plot)
+        counts = dict(
+            (cls, self.count_plot_classes(plot, cls)) for (cls, max) in plot_max
+        )
 
+        # complicate_plot doesn't recurse, so there is no need to flatten
+        # the plot between rounds; the revisions below flatten it anyway.
+        for i in xrange(0, depth):
+            plot = self.complicate_plot(plot, counts=counts, plot_max=plot_max)
         self.commuted_plots = []
-        plot = plot.flatten()
-        plot = self.commute_commutable_plots(plot)
-
-        plot = plot.flatten()
-        plot = self.encounter_new_settings(plot)
-        plot = plot.flatten()
-        plot = self.add_journeys(plot)
-
-        chekovs_guns = {}
-        self.find_chekovs_guns(plot, chekovs_guns)
-
-        self.added_chekovs_fun = False
-        for chekovs_gun, holders in chekovs_guns.iteritems():
+        plot_points = self.remove_plot_holes(plot.all_children())
+        plot_points = self.remove_repetitive_plots(plot_points)
+        plot_points = self.commute_commutable_plots(plot_points)
+        plot_points = self.encounter_new_settings(plot_points)
+        plot_points = self.add_journeys(plot_points)
+
+        revised = []
+        gun_holders = {}
+        for plot_point in plot_points:
+            if isinstance(plot_point, LoseItem):
+                if plot_point.object not in gun_holders:
+                    gun_holders[plot_point.object] = set([plot_point.subject])
+            revised.append(plot_point)
+
+        chekovs_guns = []
+        for chekovs_gun, holders in gun_holders.iteritems():
             # TODO interesting variation: could we have BOTH of them as holders?
             holder = random.choice(holders)
-            plot = self.add_chekovs_gun(plot, holder, chekovs_gun)
-            plot = plot.flatten()
+            chekovs_guns.append((holder, chekovs_gun))
+
+        plot = plot.__class__(
+            *self.add_chekovs_guns(revised, chekovs_guns), **dict(plot.iteritems())
+        )
 
         return plot
 
+    @instrument.stage
     def plot_to_story(self, plot):
         plot = plot.flatten()
         scenes = []
@@ -757,20 +782,17 @@ class Plotter(object):
         return Story(*scenes)
 
     def count_plot_classes(self, plot, cls):
-        if isinstance(plot, cls):
-            return 1
-        return sum([self.plot_contains_class(c, cls) for c in plot])
+        return plot.count_class(cls)
 
     def plot_contains_class(self, plot, cls):
-        if isinstance(plot, cls):
-            return True
-        return any([self.plot_contains_class(c, cls) for c in plot])
+        return plot.count_class(cls) > 0
 
+    @instrument.stage
     def generate_acceptable_plot(self, plot_min=(), plot_max=(),
                                  plot_depth=5, **kwargs):
         acceptable_plot = False
         while not acceptable_plot:
-            plot = self.write_plot(depth=plot_depth)
+            plot = self.write_plot(depth=plot_depth, plot_max=plot_max)
             acceptable_plot = True
             for (cls, min) in plot_min:
                 if self.count_plot_classes(plot, cls) < min:
@@ -6,8 +6,22 @@ from marysue.objects import Object
 from marysue.state import State
 
 
-def proofread(text):
-    text = text.replace("`", "'")
+class Proofreader(object):
+    """Makes a set of literal rewrites to a text, all in a single scan,
+    using one regex that matches any of them (longest first.)"""
+
+    def __init__(self, rewrites):
+        self.rewrites = rewrites
+        self.pattern = re.compile('|'.join([
+            re.escape(s) for s in sorted(rewrites, key=len, reverse=True)
+        ]))
+
+    def proofread(self, text):
+        return self.pattern.sub(lambda match: self.rewrites[match.group(0)], text)
+
+
+def standard_rewrites():
+    rewrites = {"`": "'"}
 
     dingus = State(Object(names=('dingus',)))
     verbs = []
@@ -15,12 +29,22 @@ def proofread(text):
         verbs.extend(list(v))
     for k, v in dingus.shouteds.iteritems():
         verbs.extend(list(v))
-    
+
     for verb in verbs:
-        text = text.replace(verb + ' he', 'he ' + verb)
-        text = text.replace(verb + ' she', 'she ' + verb)
+        rewrites[verb + ' he'] = 'he ' + verb
+        rewrites[verb + ' she'] = 'she ' + verb
 
-    return text
+    return rewrites
+
+
+proofreader = None
+
+
+def proofread(text):
+    global proofreader
+    if proofreader is None:
+        proofreader = Proofreader(standard_rewrites())
+    return proofreader.proofread(text)
 
 
 def word_count(text):
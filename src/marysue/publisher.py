@@ -2,11 +2,14 @@
 
 import os
 import sys
-from tempfile import mkstemp
+from contextlib import contextmanager
+from itertools import imap, izip
+from tempfile import mkstemp, TemporaryFile
 
 import marysue.util as random
+import marysue.instrument as instrument
 from marysue.util import capitalize, log
-from marysue.editor import edit_story
+from marysue.ast import walk
 from marysue.proofreader import proofread, word_count
 
 
@@ -25,34 +28,40 @@ CHAPTERS IN ANY 48 (FORTY EIGHT) HOUR PERIOD.
 
 """
 
-    def __init__(self, chapters, generate_front_matter=True, synopsis=False, dump=False):
+    def __init__(self, chapters, generate_front_matter=True, synopsis=False, dump=False,
+                       word_target=50000, debug=False, report_file=None):
         self.chapters = chapters
+        self.word_target = word_target
+        self.debug = debug
+        self.report_file = report_file
         self.generate_front_matter = generate_front_matter
         self.synopsis = synopsis
         self.dump = dump
 
-        self.text = ''
         self.used_titles = set()
         self.introduced = set()
 
+        # the text of each chapter is kept here, not in memory; see spool_text
+        self.spool = None
+
     def suggest_title_objects(self, plot, objects=None):
         from marysue.plot import Kidnapping, LoseItem, Vanquished
 
         if objects is None:
             objects = set()
-        if isinstance(plot, Kidnapping):
-            objects.add(plot.subject)
-        if isinstance(plot, (LoseItem, Vanquished)):
-            objects.add(plot.object)
-        for child in plot:
-            self.suggest_title_objects(child, objects=objects)    
+        for node in walk(plot):
+            if isinstance(node, Kidnapping):
+                objects.add(node.subject)
+            if isinstance(node, (LoseItem, Vanquished)):
+                objects.add(node.object)
         return objects
 
     def pick_title(self, plot):
         titles = [o.definite for o in self.suggest_title_objects(plot)]
         if not titles:
             titles = ['The Destiny of Fate']
-        base_title = capitalize(random.choice(tuple(titles)))
+        with self.title_rng:
+            base_title = capitalize(random.choice(tuple(titles)))
         prefixes = [
             'The Return of ',
             'The Revenge of ',
@@ -77,109 +86,267 @@ CHAPTERS IN ANY 48 (FORTY EIGHT) HOUR PERIOD.
 
         return title
 
-    def generate_chapter(self, n, plotter, **kwargs):
-        ### tell the plotter to give us an acceptable plot ###
-
-        plot = plotter.generate_acceptable_plot(**kwargs)
-
-        ### dump the synopsis, if requested ###
-
-        if self.synopsis:
-            plot.print_synopsis()
-            sys.exit(0)
-
-        ### write a story around the plot, then edit it ###
-
-        story = plotter.plot_to_story(plot)
-
-        story = edit_story(story, self.introduced, **kwargs)
+    def generate_chapters(self, make_plotter, rng, jobs=1):
+        """Generates all of the chapters of the novel.
+
+        `make_plotter(n)` should set up the world as it stands at the
+        start of chapter `n` and return a Plotter for that chapter.
+
+        Each chapter is generated from its own random streams, split off
+        from `rng` (a RandomContext), so the chapters can be generated in
+        any order -- and, if `jobs` is greater than 1, in a pool of that
+        many worker processes.  (In that case `make_plotter` must be
+        picklable.)  The state that carries over from one chapter to the
+        next is reconciled in a sequential pass between plotting the
+        chapters and writing them.
+
+        Middle chapters which, going by estimates of their lengths made
+        from their plots, would only be cut again by trim() are dropped
+        without being written.
+        """
+        contexts = [
+            ChapterContext(make_plotter, rng, n, dict(chapter),
+                           debug=self.debug, report_file=self.report_file)
+            for (n, chapter) in enumerate(self.chapters)
+        ]
 
-        ### dump the story, if requested ###
+        ### dump the synopsis or the story of the first chapter, if requested ###
 
-        if self.dump:
-            story.dump(sys.stdout)
+        if self.synopsis or self.dump:
+            self.print_chapter(contexts[0])
             sys.exit(0)
 
-        ### give the thing a title that hasn't been used yet ###
-
-        self.chapters[n]['commuted_plots'] = plotter.commuted_plots
-        self.chapters[n]['plot'] = plot
-        self.chapters[n]['title'] = self.pick_title(plot)
-
-        ### install it in the chapters ###
-
-        text = story.render()
-        text = proofread(text)
-
-        self.chapters[n]['text'] = text
-        self.chapters[n]['word_count'] = word_count(text)
+        pool = None
+        map_ = imap
+        if jobs > 1:
+            from multiprocessing import Pool
+            pool = Pool(jobs)
+            # One chapter per task, so that each result is pickled as soon
+            # as its chapter is done, while the world (e.g. ranks) is still
+            # as it was set up for that chapter.  Results are handed over
+            # one at a time, as they come in, so that each chapter's text
+            # can be spooled before the next one's arrives.
+            map_ = lambda f, jobs_: pool.imap(f, jobs_, chunksize=1)
+
+        try:
+            ### tell the plotters to give us acceptable plots ###
+
+            plots = list(map_(plot_chapter, contexts))
+
+            ### work out who has been introduced by the start of each chapter ###
+
+            jobs_ = []
+            for n, (plot, commuted_plots) in enumerate(plots):
+                contexts[n].introduced = frozenset(self.introduced)
+                jobs_.append((contexts[n], plot))
+                self.introduced.update(involved_characters(plot))
+
+            ### write stories around the plots ###
+
+            # Chapters other than middle ones are always kept, so write those
+            # first.  Then estimate how long each middle chapter would be,
+            # from how many plot points it has, at the rate the chapters
+            # written so far came out at; and write only the middle chapters
+            # that wouldn't be cut, going by the estimates.  If they were
+            # overestimates, and there aren't enough words after all, write
+            # the rest, in order, until there are.  (None of this counts the
+            # chapter headings, so it errs on the side of writing too much;
+            # trim() takes care of that.)  Those are written a batch of
+            # `jobs` at a time, but any in a batch that come after the target
+            # was reached are dropped, so the novel is the same however many
+            # jobs there are.
+            #
+            # The text of each chapter that is kept is spooled as soon as it
+            # is written, so only one chapter's text is in memory at a time.
+
+            def write_chapters(ns):
+                """Yields the number, text, and word count of each of the
+                chapters numbered `ns`, as it is written."""
+                for n, (text, wc) in izip(ns, map_(write_chapter, [jobs_[n] for n in ns])):
+                    yield (n, text, wc)
+
+            def words_so_far():
+                wc = sum([wc for (spooled, wc) in texts.itervalues()])
+                if self.generate_front_matter:
+                    wc += word_count(self.contents_heading())
+                return wc
+
+            middle = [n for (n, c) in enumerate(self.chapters) if c.get('position') == 'middle']
+            fixed = [n for n in xrange(0, len(self.chapters)) if n not in middle]
+            texts = {}
+            for (n, text, wc) in write_chapters(fixed):
+                texts[n] = (self.spool_text(text), wc)
+
+            points = [len(list(plot.all_children())) for (plot, commuted_plots) in plots]
+            rate = float(sum([wc for (spooled, wc) in texts.itervalues()])) / max(
+                sum([points[n] for n in fixed]), 1
+            )
+            estimates = [int(rate * points[n]) for n in middle]
+            overrun = words_so_far() + sum(estimates) - self.word_target
+            unwanted = set([middle[i] for i in plan_cuts(estimates, overrun)])
+            wanted = [n for n in middle if n not in unwanted]
+            for (n, text, wc) in write_chapters(wanted):
+                texts[n] = (self.spool_text(text), wc)
+
+            pending = [n for n in middle if n in unwanted]
+            while pending and words_so_far() < self.word_target:
+                batch = pending[:max(jobs, 1)]
+                pending = pending[len(batch):]
+                for (n, text, wc) in write_chapters(batch):
+                    if words_so_far() < self.word_target:
+                        texts[n] = (self.spool_text(text), wc)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        for n in middle:
+            if n not in texts:
+                log('skipping:', n)
+
+        ### install them in the chapters and give them titles ###
+
+        self.title_rng = rng.split('titles')
+        chapters = []
+        for n, chapter in enumerate(self.chapters):
+            if n not in texts:
+                continue
+            (plot, commuted_plots) = plots[n]
+            (spooled, wc) = texts[n]
+            chapter['commuted_plots'] = commuted_plots
+            chapter['plot'] = plot
+            chapter['title'] = self.pick_title(plot)
+            chapter['spooled'] = spooled
+            chapter['word_count'] = wc
+            chapters.append(chapter)
+        self.chapters = chapters
 
-    def assemble_novel_text(self):
-        self.text = ''
+    def chapter_context(self, make_plotter, rng, k):
+        """Returns the ChapterContext for chapter `k` of the novel, without
+        writing any of the chapters before it.  (It does have to plot them,
+        to know who has been introduced by then, but that's cheap.)"""
+        introduced = set()
+        for n in xrange(0, k):
+            (plot, commuted_plots) = ChapterContext(
+                make_plotter, rng, n, dict(self.chapters[n])
+            ).plot()
+            introduced.update(involved_characters(plot))
+        return ChapterContext(
+            make_plotter, rng, k, dict(self.chapters[k]), introduced=introduced,
+            debug=self.debug, report_file=self.report_file
+        )
+
+    def print_chapter(self, context):
+        """Prints the synopsis, the story tree, or the text of a single chapter."""
+        (plot, commuted_plots) = context.plot()
+        if self.synopsis:
+            plot.print_synopsis()
+        elif self.dump:
+            context.write_story(plot).dump(sys.stdout)
+        else:
+            (text, wc) = context.write(plot)
+            sys.stdout.write(text)
+
+    def contents_heading(self):
+        return self.front_matter + '\n\n## Contents\n\n' + '<a name="contents"></a>\n\n'
+
+    def contents_line(self, n, chapter):
+        return '1. [%s](#%s)  \n' % (chapter['title'], n)
+
+    def chapter_heading(self, n, chapter):
+        return (
+            ('<a name="%s"></a>\n\n' % n) +
+            ('## %s. %s' % (n+1, chapter['title'])) +
+            #('(%s)' % chapter['commuted_plots']) +
+            '\n\n'
+        )
+
+    def spool_text(self, text):
+        """Saves the text of a chapter to the spool, a temporary file, and
+        returns where in it it is, so that the text of every chapter need
+        not be kept in memory until the novel is written."""
+        if self.spool is None:
+            self.spool = TemporaryFile()
+        self.spool.seek(0, os.SEEK_END)
+        start = self.spool.tell()
+        self.spool.write(text)
+        return (start, len(text))
+
+    def write(self, f):
+        """Writes the text of the novel to the file-like object `f`, piece
+        by piece, copying the text of each chapter from the spool, so only
+        one chapter's text is in memory at a time."""
 
         # [WHARRGARBL](http://i1.kym-cdn.com/photos/images/newsfeed/000/032/388/wharrgarbl.jpg).
 
         if self.generate_front_matter:
-            self.text += self.front_matter
-            self.text += '\n\n## Contents\n\n'
-            self.text += '<a name="contents"></a>\n\n'
+            f.write(self.contents_heading())
             for n, chapter in enumerate(self.chapters):
-                self.text += '1. [%s](#%s)  \n' % (chapter['title'], n)
-            self.text += '\n\n'
+                f.write(self.contents_line(n, chapter))
+            f.write('\n\n')
 
         for n, chapter in enumerate(self.chapters):
-            self.text += (
-                ('<a name="%s"></a>\n\n' % n) +
-                ('## %s. %s' % (n+1, chapter['title'])) +
-                #('(%s)' % chapter['commuted_plots']) +
-                '\n\n' +
-                chapter['text'] +
-                '\n\n'
-            )
-            #self.text += '[Up to Table of Contents](#contents)\n\n'
+            f.write(self.chapter_heading(n, chapter))
+            (start, length) = chapter['spooled']
+            self.spool.seek(start)
+            f.write(self.spool.read(length))
+            f.write('\n\n')
+            #f.write('[Up to Table of Contents](#contents)\n\n')
+
+    def novel_word_count(self):
+        """Returns the word count of the text of the novel, without having
+        to write it.  Every piece of the novel text ends in whitespace, so
+        its word count is the sum of theirs."""
+        wc = 0
+        if self.generate_front_matter:
+            wc += word_count(self.contents_heading())
+        for n, chapter in enumerate(self.chapters):
+            wc += self.chapter_word_count(n, chapter)
+        return wc
+
+    def chapter_word_count(self, n, chapter):
+        """Returns how many words chapter `n` contributes to the novel,
+        counting its heading and its line in the table of contents."""
+        wc = word_count(self.chapter_heading(n, chapter)) + chapter['word_count']
+        if self.generate_front_matter:
+            wc += word_count(self.contents_line(n, chapter))
+        return wc
 
     def trim(self):
         ### trim the novel to reasonable length ###
-        
-        # Note: this isn't perfect, because every time we cut a chapter,
-        # we make the table of contents shorter too.  But, it's usually OK.
-        # The total number of words outside of any chapter is usually around 500.
-        
-        done = False
-        while not done:
-            self.assemble_novel_text()
-            self.novel_wc = word_count(self.text)
-            overrun = self.novel_wc - 50000
-            could_be_cut = [(n, c) for (n, c) in enumerate(self.chapters) if c['word_count'] < overrun and c['position'] == 'middle']
-            could_be_cut.sort(key=lambda pair: pair[1]['word_count'])
-            if could_be_cut:
-                n, chapter = could_be_cut[0]
-                log('cutting:', n, chapter['title'], chapter['word_count'])
-                self.chapters.remove(chapter)
-            else:
-                done = True
+
+        # Cut whichever middle chapters bring the novel closest to the word
+        # target without going under it.  The chapters keep the titles they
+        # were given when they were written (which are still all different
+        # once some are cut), so the headings and the table of contents can
+        # be counted now; and which chapter is numbered what doesn't change
+        # how many words its heading has, so it can be counted before the
+        # chapters are renumbered.
+
+        self.novel_wc = self.novel_word_count()
+        overrun = self.novel_wc - self.word_target
+        middle = [(n, c) for (n, c) in enumerate(self.chapters) if c.get('position') == 'middle']
+        cuts = plan_cuts([self.chapter_word_count(n, c) for (n, c) in middle], overrun)
+        for i in cuts:
+            n, chapter = middle[i]
+            log('cutting:', n, chapter['title'], chapter['word_count'])
+        cut = set([middle[i][0] for i in cuts])
+        self.chapters = [c for (n, c) in enumerate(self.chapters) if n not in cut]
 
         self.total_wc = sum([chapter['word_count'] for chapter in self.chapters])
         self.avg_wc = (self.total_wc * 1.0) / (len(self.chapters) * 1.0)
 
-        self.retitle_chapters()
-        self.assemble_novel_text()
-        self.novel_wc = word_count(self.text)
+        self.novel_wc = self.novel_word_count()
 
         for n, c in enumerate(self.chapters):
             if c['commuted_plots']:
                 log(n+1, c['commuted_plots'])
 
-    def retitle_chapters(self):
-        self.used_titles = set()
-        for n, c in enumerate(self.chapters):
-            c['title'] = self.pick_title(c['plot'])
-
     def publish(self):
         fd, temp_filename = mkstemp(suffix='.md')
         os.close(fd)
         with open(temp_filename, 'w') as f:
-            f.write(self.text)
+            self.write(f)
             f.write("## word counts for this novel\n\n")
             for n, chapter in enumerate(self.chapters):
                 f.write("Chapter %02d: %s  \n" % (n + 1, chapter['word_count']))
@@ -200,3 +367,129 @@ CHAPTERS IN ANY 48 (FORTY EIGHT) HOUR PERIOD.
                     else:
                         f_out.write(line)
         os.system("firefox %s &" % output_filename)
+
+
+# - - - - the stages of generating a chapter - - - -
+
+
+class ChapterContext(object):
+    """Everything that generating chapter `n` of a novel depends on:
+
+    * the novel's RandomContext, `rng`, from which a separate random stream
+      (with its own Shuffle Demon) is split off for each stage of generating
+      the chapter, so nothing random is carried over from other chapters;
+    * `make_plotter`, which sets up the world (e.g. ranks) as it stands at
+      the start of chapter `n`, and returns a Plotter for it;
+    * the chapter's `config`, i.e. the arguments to generate_acceptable_plot;
+    * the set of characters `introduced` in the chapters before it.
+
+    Contexts can be pickled, as long as `make_plotter` can be.
+
+    If `debug` is set, statistics about plotting and writing the chapter
+    are logged, including a JSON report on each stage of them (see
+    marysue.instrument.)  If `report_file` is given, the reports are
+    appended to that file, one per line, too.
+    """
+
+    def __init__(self, make_plotter, rng, n, config, introduced=frozenset(),
+                 debug=False, report_file=None):
+        self.make_plotter = make_plotter
+        self.rng = rng
+        self.n = n
+        self.config = config
+        self.introduced = frozenset(introduced)
+        self.debug = debug
+        self.report_file = report_file
+
+    @contextmanager
+    def reporting(self, phase):
+        if not (self.debug or self.report_file):
+            yield
+            return
+        with instrument.Report(chapter=self.n, phase=phase) as report:
+            yield
+        text = report.to_json()
+        if self.debug:
+            log(text)
+        if self.report_file:
+            # Each line goes to the end of the file in a single write(), so
+            # that the lines from workers writing at the same time don't get
+            # mixed up.  (Python's file objects would split long lines up
+            # into several writes, whenever their buffer filled.)
+            fd = os.open(self.report_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0666)
+            try:
+                os.write(fd, text + '\n')
+            finally:
+                os.close(fd)
+
+    def plot(self):
+        with self.rng.split(self.n, 'plot'), self.reporting('plot'):
+            plotter = self.make_plotter(self.n)
+            plot = plotter.generate_acceptable_plot(**self.config)
+        return (plot, plotter.commuted_plots)
+
+    def write_story(self, plot, rng=None):
+        """Writes a story around the plot for the chapter, then edits it."""
+        from marysue.editor import edit_story
+        with rng or self.rng.split(self.n, 'story'):
+            plotter = self.make_plotter(self.n)
+            story = plotter.plot_to_story(plot)
+            return edit_story(story, set(self.introduced), **self.config)
+
+    def write(self, plot):
+        # the story is rendered with the rest of the stream it was written with
+        rng = self.rng.split(self.n, 'story')
+        with self.reporting('write'):
+            story = self.write_story(plot, rng=rng)
+            with rng:
+                text = instrument.run('render', story.__class__.render, story)
+            text = instrument.run('proofread', proofread, text)
+        if self.debug:
+            log('chapter', self.n)
+            rng.shuffle_demon.dump_stats(sys.stderr)
+        return (text, word_count(text))
+
+
+# These take a single argument, so that they can be handed to a
+# multiprocessing Pool.
+
+
+def plot_chapter(context):
+    return context.plot()
+
+
+def write_chapter(job):
+    (context, plot) = job
+    return context.write(plot)
+
+
+def plan_cuts(costs, budget):
+    """Returns the (sorted) indices of the subset of `costs` with the
+    largest sum that does not exceed `budget`.
+
+    This is subset-sum, done with a bitset: bit `k` of `reachable[i]`
+    is set if some subset of the first `i` costs sums to `k`.
+    """
+    if budget <= 0:
+        return []
+    mask = (1 << (budget + 1)) - 1
+    reachable = [1]
+    for cost in costs:
+        r = reachable[-1]
+        reachable.append((r | (r << cost)) & mask)
+
+    total = reachable[-1].bit_length() - 1
+    cuts = []
+    for i in reversed(xrange(len(costs))):
+        if not (reachable[i] >> total) & 1:
+            cuts.append(i)
+            total -= costs[i]
+    assert total == 0
+    return sorted(cuts)
+
+
+def involved_characters(plot):
+    characters = set()
+    for plot_point in plot.flatten():
+        characters.update(plot_point.all_involved_characters())
+    return characters
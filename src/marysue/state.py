@@ -29,14 +29,22 @@ class State(Properties):
              'mood',
              'location',)
 
+    # how many States have been cloned, ever; see marysue.instrument
+    clones = 0
+
     def __init__(self, object, **kwargs):
-        assert isinstance(object, Object), repr(object)
+        if random.validating():
+            assert isinstance(object, Object), repr(object)
         kwargs['object'] = object
         super(State, self).__init__(**kwargs)
 
+    def clone(self, **kwargs):
+        State.clones += 1
+        return super(State, self).clone(**kwargs)
+
     def __getattr__(self, name):
         if name in self.slots:
-            return self._attrs[name]
+            raise AttributeError(name)
         if not hasattr(self.object, name) and name not in dir(self.object):
             # FIXME should be AttributeError but something catches that
             raise KeyError(name)
@@ -1,61 +1,80 @@
-from marysue.ast import AST
+from marysue.ast import AST, flattened_children
 from marysue.util import capitalize
 
 
-class Story(AST):
+def capitalize_from(out, start):
+    """Capitalizes the text in the list of fragments `out` which begins at
+    index `start`, like `capitalize` does to a string."""
+    for i in xrange(start, len(out)):
+        if any(c.isalpha() for c in out[i]):
+            out[i] = capitalize(out[i])
+            return
+
+
+def render_joined(children, sep, out, capitalized=False):
+    for n, child in enumerate(children):
+        if n > 0:
+            out.append(sep)
+        start = len(out)
+        child.render_into(out)
+        if capitalized:
+            capitalize_from(out, start)
+
+
+class StoryTree(AST):
+    """The nodes of the story tree above the level of events, which render
+    their text into a list of fragments shared by the whole tree."""
+
     def render(self):
-        return (
-            '\n\n- - - -\n\n'.join([child.render() for child in self])
-        )
+        out = []
+        self.render_into(out)
+        return ''.join(out)
+
 
+class Story(StoryTree):
+    def render_into(self, out):
+        render_joined(self, '\n\n- - - -\n\n', out)
 
-class Scene(AST):
+
+class Scene(StoryTree):
     slots = ('setting',)
 
-    def render(self):
-        return '\n\n'.join([child.render() for child in self])
+    def render_into(self, out):
+        render_joined(self, '\n\n', out)
 
 
-class EventSequence(AST):
-    def render(self):
-        return '\n\n'.join([capitalize(child.render()) for child in self])
+class EventSequence(StoryTree):
+    def render_into(self, out):
+        render_joined(self, '\n\n', out, capitalized=True)
 
     def flatten(self):
         return EventSequence(*list(self.all_children()), **dict(self.iteritems()))
 
     def all_children(self):
-        for child in self:
-            if isinstance(child, EventSequence):
-                for descendant in child.all_children():
-                    yield descendant
-            else:
-                yield child
+        return flattened_children(self, EventSequence)
 
 
 # - - - -
 
 
-class Paragraph(AST):
+class Paragraph(StoryTree):
     """Only used at the end"""
-    def render(self):
+    def render_into(self, out):
         from marysue.events import Event
 
-        s = ''
-        for child in self:
-            s += capitalize(child.render())
+        for n, child in enumerate(self):
+            if n > 0:
+                out.append('  ')
+            start = len(out)
+            child.render_into(out)
+            capitalize_from(out, start)
             if isinstance(child, Event) and child.exciting:
-                s += '!  '
+                out.append('!')
             else:
-                s += '.  '
-        return s.rstrip()
+                out.append('.')
 
     def flatten(self):
         return Paragraph(*list(self.all_children()), **dict(self.iteritems()))
 
     def all_children(self):
-        for child in self:
-            if isinstance(child, Paragraph):
-                for descendant in child.all_children():
-                    yield descendant
-            else:
-                yield child
+        return flattened_children(self, Paragraph)
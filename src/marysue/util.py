@@ -1,27 +1,61 @@
 # encoding: UTF-8
 
+import os
 import string
 import sys
 import random
+import threading
+from collections import OrderedDict
 
 
 # ...stolen from seedbank https://github.com/catseye/seedbank/ ...
-def autoseed():
-    from datetime import datetime
-    import os
-    import sys
-
+# ...but nothing here is done until something actually needs a seed.
+
+def seedbank_filename():
+    """Returns the name of the seedbank log, or None if there is to be no
+    log (if the SEEDBANK_LOG environment variable is set but empty.)"""
+    filename = os.getenv('SEEDBANK_LOG')
+    if filename is not None:
+        return filename or None
     base_filename = 'seedbank.log'
     filename = os.path.join(os.getenv('HOME'), base_filename)
     if not os.path.exists(filename):
         filename = base_filename
+    return filename
+
+
+def last_logged_seed(filename, block_size=4096):
+    """Returns the seed on the last line of the seedbank log, reading the
+    file backwards from the end until it has that whole line."""
+    with open(filename, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        tail = ''
+        while True:
+            lines = tail.rstrip('\n').split('\n')
+            if len(lines) > 1 or pos == 0:
+                return int(lines[-1].split(':')[-1].strip())
+            step = min(block_size, pos)
+            pos -= step
+            f.seek(pos)
+            tail = f.read(step) + tail
+
+
+def autoseed():
+    """Returns the seed given in the SEEDBANK_SEED environment variable (if
+    it is LAST, the one on the last line of the seedbank log), or a new
+    random one if none is given, and logs it.
+
+    The seed is logged straight away, not when the process exits, so that
+    it is there even if the process is killed -- e.g. by a job runner,
+    because it hung, which is just when you'd want to reproduce the run."""
+    from datetime import datetime
+
+    filename = seedbank_filename()
 
     seed_ = os.getenv('SEEDBANK_SEED', None)
     if seed_ == 'LAST':
-        with open(filename, 'r') as f:
-            for line in f:
-                pass
-            seed_ = int(line.split(':')[-1].strip())
+        seed_ = last_logged_seed(filename)
     try:
         seed_ = int(seed_)
     except TypeError:
@@ -29,23 +63,134 @@ def autoseed():
     if seed_ is None:
         seed_ = random.randint(0, 1000000)
 
-    with open(filename, 'a') as f:
-        f.write('%s: %s: %s\n' % (sys.argv[0], datetime.now(), seed_))
-    random.seed(seed_)
+    if filename is not None:
+        entry = '%s: %s: %s\n' % (sys.argv[0], datetime.now(), seed_)
+        # one short write to the end of the file, so that processes seeding
+        # at the same time don't get their lines mixed up
+        fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0666)
+        try:
+            os.write(fd, entry)
+        finally:
+            os.close(fd)
+
     return seed_
 
-autoseed()
+
+def derive_seed(seed_, *path):
+    """Deterministically derives a new seed from `seed_` and the given
+    path (e.g. a chapter number and the name of a stage), so that the
+    thing identified by that path can be generated on its own."""
+    from hashlib import md5
+    return int(md5(repr((seed_,) + path)).hexdigest()[:8], 16)
+
+
+class RandomContext(object):
+    """A stream of random numbers, with its own Shuffle Demon, which can
+    be split into independent child streams.
+
+    The functions in this module draw from the current context, which is
+    the one most recently entered with `with` (in the current thread),
+    or `root()` if there is none.
+    """
+
+    def __init__(self, seed_, shuffle=True):
+        self.seed = seed_
+        self.random = random.Random(seed_)
+        self.shuffle_demon = ShuffleDemon(self.random)
+        self.shuffle_demon.enabled = shuffle
+
+    def split(self, *path):
+        """Returns a new context whose stream depends only on this context's
+        seed and the given path -- not on anything drawn from this one."""
+        return RandomContext(
+            derive_seed(self.seed, *path), shuffle=self.shuffle_demon.enabled
+        )
+
+    def __enter__(self):
+        contexts().append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        contexts().pop()
+
+
+local = threading.local()
+
+
+def contexts():
+    if not hasattr(local, 'contexts'):
+        local.contexts = []
+    return local.contexts
+
+
+def current():
+    stack = contexts()
+    return stack[-1] if stack else root()
+
+
+root_context = None
+
+
+def root():
+    """Returns the root RandomContext, seeding it with autoseed() if it
+    hasn't been seeded yet."""
+    if root_context is None:
+        seed(autoseed())
+    return root_context
+
+
+def seed(seed_):
+    global root_context
+    root_context = RandomContext(seed_)
+
+
+# - - - - validation
+
+
+# How much of the (slow) checking of arguments to do: 'off', 'sampling'
+# (one check in every SAMPLING_INTERVAL), or 'full'.  Taken from the
+# MARYSUE_VALIDATION environment variable, or set with set_validation.
+
+VALIDATION_LEVELS = ('off', 'sampling', 'full')
+SAMPLING_INTERVAL = 100
+
+validation_level = 'off'
+validation_count = 0
+
+
+def set_validation(level):
+    global validation_level
+    if level not in VALIDATION_LEVELS:
+        raise ValueError("validation level must be one of %s, not %r" % (
+            ', '.join(VALIDATION_LEVELS), level
+        ))
+    validation_level = level
+
+
+def validating():
+    """Returns whether the check about to be made should be made.  (When
+    sampling, this counts checks; it never consumes random numbers.)"""
+    global validation_count
+    if validation_level == 'off':
+        return False
+    if validation_level == 'full':
+        return True
+    validation_count += 1
+    return validation_count % SAMPLING_INTERVAL == 1
+
+
+set_validation(os.getenv('MARYSUE_VALIDATION', 'off'))
 
 
 # - - - -
 
 
 def chance(percent, obj=True):
-    return obj if random.randint(1, 100) <= percent else None
+    return obj if current().random.randint(1, 100) <= percent else None
 
 
 def lowercase():
-    return random.choice(string.lowercase)
+    return current().random.choice(string.lowercase)
 
 
 def extract(v, filter=lambda x: True):
@@ -58,7 +203,7 @@ def extract(v, filter=lambda x: True):
     z = [x for x in v if filter(x)]
     if not z:
         return None
-    p = random.choice(z)
+    p = current().random.choice(z)
     v.remove(p)
     return p
 
@@ -70,58 +215,79 @@ class ShuffleDemon(object):
 
     """
 
-    def __init__(self):
-        self.registry = {}
+    def __init__(self, rng, capacity=1024):
+        self.rng = rng
         self.enabled = True
+        # id(tup) -> [tup, bag, number of choices made from it], least
+        # recently used first.  The entry holds on to the tuple itself, so
+        # its id can't be reused by another tuple while the entry is there.
+        self.registry = OrderedDict()
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self.refills = 0
+        self.evictions = 0
 
     def choice(self, tup):
+        """Picks one of the items of `tup`, but none of them twice until
+        all of them have been picked.  Each tuple has a bag of its items,
+        shuffled when it is (re)filled, which choices are popped from.
+
+        Bags are kept for the tuple object, not for whatever it equals, so
+        equal tuples don't share a bag, and a tuple which is built anew
+        every time gets a new bag every time.  (Looking the bag up by id
+        saves hashing the whole tuple on every choice.)"""
 
         if not self.enabled:
-            return random.choice(tup)
+            return self.rng.choice(tup)
 
-        if tup not in self.registry:
+        key = id(tup)
+        entry = self.registry.pop(key, None)
+        if entry is None or entry[0] is not tup:
             #log(repr(tup))
-            self.registry[tup] = set()
-
-        if not self.registry[tup]:
-            self.registry[tup] = set(tup)
-
-        return extract(self.registry[tup])
-
+            self.misses += 1
+            entry = [tup, self.fill(tup), 0]
+            if len(self.registry) >= self.capacity:
+                self.registry.popitem(last=False)
+                self.evictions += 1
+        else:
+            self.hits += 1
+            if not entry[1]:
+                self.refills += 1
+                entry[1] = self.fill(tup)
+        self.registry[key] = entry
+
+        entry[2] += 1
+        return entry[1].pop()
+
+    def fill(self, tup):
+        seen = set()
+        bag = []
+        for item in tup:
+            if item not in seen:
+                seen.add(item)
+                bag.append(item)
+        self.rng.shuffle(bag)
+        return bag
+
+    def dump_stats(self, f, top=10):
+        f.write('shuffle demon: %d hits, %d misses, %d refills, %d evictions\n' % (
+            self.hits, self.misses, self.refills, self.evictions
+        ))
+        entries = sorted(self.registry.itervalues(), key=lambda entry: entry[2], reverse=True)
+        for (tup, bag, count) in entries[:top]:
+            f.write('  %5d  %s\n' % (count, repr(tup)[:70]))
 
-shuffle_demon = ShuffleDemon()
 
 
 def choice(v):
     if isinstance(v, set):
         v = tuple(v)
-    return random.choice(v)
-
-
-def _choice(v):
-    """This variant of Python's `random.choice` is enhanced to allow it to
-    operate on `set`s, and to allow it to use the ShuffleDemon when
-    it works on tuples."""
-
-    from marysue.objects import Object, Group   # sigh!!!
-    from marysue.ast import AST
-    if isinstance(v, set):
-        return random.choice(tuple(v))
-    if isinstance(v, Group):
-        return random.choice(v)
-
-    assert isinstance(v, tuple), repr(v) + ' ... ' + v.__class__.__name__
-    for i in v:
-        assert isinstance(
-            i, (basestring, Object, AST, tuple)
-        ), i.__class__.__name__
-    assert sorted(v) == sorted(set(v)), repr(v)
-
-    return shuffle_demon.choice(v)
+    return current().random.choice(v)
 
 
 def randint(*args):
-    return random.randint(*args)
+    return current().random.randint(*args)
 
 
 # - - - - non-randomness-related things